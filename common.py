@@ -5,55 +5,49 @@
     + Creating a plot of surface density, Q at the solar radius against time
     + Creating a movie of the surface density evolution map
     + Creating a movie of the toomre Q evolution map
+    + Creating a movie of the two fluid (gas + stars) toomre Q evolution map
 
     By using the argument --save, one can also save these things to a file
     called processed_variables.pkl
 
+    With --pyramid N a map pyramid with N levels (see survis.pyramid) of each
+    snapshot's grids is kept too, which is saved along with the rest. Its
+    finest level has cells of res_elem / 2**(N - 1), the maps and movies
+    are still made at res_elem.
+
+    With --stream the snapshots are only kept as running statistics, which
+    uses far less memory for long runs. The movies are then replaced with
+    maps of the time averaged Q (and its scatter) and surface density.
+
     Please note that by default this uses the Supernovae equation of state
     rather than an isothermal one when calculting the Toomre Q parameter.
 """
 
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib.cm as cm
-import matplotlib.colors as col
-import matplotlib.animation as animation
-from tqdm import tqdm
 import survis
+from survis.run import analyse, aggregate, get_pyramid_levels
+from survis.run import setup, bbox_x, bbox_y, res_elem
+
+# The plotting modules are imported in the functions that use them so that
+# worker processes, which re-import this file under the spawn start method,
+# do not have to load them. See survis/run.py for analysis without plotting.
 
 # Constants
 solar_radius = 8.  # kpc
 smoothing = 0.2 * 2  # kpc
 
-        
-def processing_run(filename, res, bbox_x, bbox_y, elem_size, callback=None):
-    """ Generates the processed data out of the snapshot """
-
-    this_data = survis.analysis.CommonDataObject(filename, res, bbox_x, bbox_y, elem_size)
-    this_data.run_analysis()
-
-    if not (callback is None):
-        callback()
-
-    return this_data
-
-
-def get_snaps(directory = "."):
-    n_snaps = 0
-
-    while "snapshot_{:03d}.hdf5".format(n_snaps) in os.listdir(directory):
-        n_snaps += 1
-        if n_snaps > 10000:
-            break
-
-    return n_snaps
-
 
 def make_movie_imshow(data, bad_color='black', log=False, vmin=0, vmax=3):
+    import matplotlib
+    import matplotlib.pyplot as plt
+    import matplotlib.colors as col
+    import matplotlib.animation as animation
+    from tqdm import tqdm
+
     images = []
 
     fig = plt.figure()
-    colormap = cm.get_cmap('viridis')
+    colormap = matplotlib.colormaps['viridis'].copy()
     c_scale = col.Normalize(vmin=vmin , vmax=vmax)
     colormap.set_bad(bad_color, 1.0)
 
@@ -68,6 +62,10 @@ def make_movie_imshow(data, bad_color='black', log=False, vmin=0, vmax=3):
 
 
 def make_linear_plot_movie(data, ylabel, ymin=0, ymax=0):
+    import matplotlib.pyplot as plt
+    import matplotlib.animation as animation
+    from tqdm import tqdm
+
     xs = np.arange(len(data[0]))*smoothing
     n_images = len(data)
     images = []
@@ -87,6 +85,8 @@ def make_linear_plot_movie(data, ylabel, ymin=0, ymax=0):
 
 
 def make_linear_plot(data, ylabel, ymin=0, ymax=5.):
+    import matplotlib.pyplot as plt
+
     n_snaps = len(data)
     fig, ax = plt.subplots()
 
@@ -102,6 +102,8 @@ def make_linear_plot(data, ylabel, ymin=0, ymax=5.):
 
 
 def n_part_r_plot(n_r, bin_edges):
+    import matplotlib.pyplot as plt
+
     n_snaps = len(n_r[0, :])
     fig, ax = plt.subplots()
 
@@ -119,6 +121,8 @@ def n_part_r_plot(n_r, bin_edges):
 
 
 def variation_with_time(data, errors=0, y_ax_lab="Scale height"):
+    import matplotlib.pyplot as plt
+
     n_snaps = len(data)
     fig, ax = plt.subplots()
 
@@ -130,8 +134,83 @@ def variation_with_time(data, errors=0, y_ax_lab="Scale height"):
     return fig, ax
 
 
+def make_map_plot(data, title, vmin=0, vmax=3, bad_color='black'):
+    import matplotlib
+    import matplotlib.pyplot as plt
+
+    fig, ax = plt.subplots()
+    colormap = matplotlib.colormaps['viridis'].copy()
+    colormap.set_bad(bad_color, 1.0)
+
+    image = ax.imshow(data, cmap=colormap, vmin=vmin, vmax=vmax)
+    fig.colorbar(image)
+    ax.set_title(title)
+
+    return fig, ax
+
+
+def make_profile_plot(radii, profiles, ylabel):
+    """ profiles is a list of (mean, minimum, maximum, label), the mean is
+        plotted against radius with the minimum to maximum range shaded. """
+    import matplotlib.pyplot as plt
+
+    fig, ax = plt.subplots()
+
+    for mean, minimum, maximum, label in profiles:
+        line, = ax.plot(radii, mean, label=label)
+        ax.fill_between(radii, np.ma.filled(minimum, np.nan),
+                        np.ma.filled(maximum, np.nan),
+                        color=line.get_color(), alpha=0.3)
+
+    ax.set_xlabel("Radius (kpc)")
+    ax.set_ylabel(ylabel)
+    ax.legend()
+
+    return fig, ax
+
+
+def make_aggregate_plots(result):
+    """ Plots the time averaged maps and radial profiles from a
+        CommonDataAggregator """
+    maps = [(result.Q_map.mean, "Mean Toomre $Q$", 0, 2, "Q_mean.pdf"),
+            (result.Q_map.std, "Standard deviation of $Q$", 0, 1, "Q_std.pdf"),
+            (result.Q_map.minimum, "Minimum Toomre $Q$", 0, 2, "Q_min.pdf"),
+            (result.Q_map.maximum, "Maximum Toomre $Q$", 0, 2, "Q_max.pdf"),
+            (result.Q2_map.mean, "Mean two fluid $Q$", 0, 2, "Q2_mean.pdf"),
+            (result.sd_map.mean, "Mean Surface Density ($M_\odot$ pc$^{-2}$)",
+             0, 50, "sd_mean.pdf")]
+
+    print("Writing time averaged maps")
+    for data, title, vmin, vmax, fname in maps:
+        fig, ax = make_map_plot(data, title, vmin, vmax)
+        fig.savefig(fname)
+
+    print("Writing time averaged radial profiles")
+    Q_r, Q2_r = result.Q_variation_with_r, result.Q2_variation_with_r
+    Q_fig, Q_ax = make_profile_plot(result.radii,
+                                    [(Q_r.mean, Q_r.minimum, Q_r.maximum, "Gas"),
+                                     (Q2_r.mean, Q2_r.minimum, Q2_r.maximum,
+                                      "Two fluid")],
+                                    "Toomre $Q$")
+    Q_fig.savefig("Q_of_r_mean.pdf")
+
+    # The surface density profiles are [gas, star] at each radius
+    sd_r = result.sd_variation_with_r
+    sd_fig, sd_ax = make_profile_plot(result.radii,
+                                      [(sd_r.mean[:, i], sd_r.minimum[:, i],
+                                        sd_r.maximum[:, i], label)
+                                       for i, label in enumerate(["Gas", "Stars"])],
+                                      "Surface Density ($M_\odot$ kpc$^{-2}$)")
+    sd_fig.savefig("sd_of_r_mean.pdf")
+
+
 def make_plots(result, make_movies=True, show_plots=False):
-    result = survis.analysis.CommonDataExtractor(result)
+    if isinstance(result, survis.analysis.CommonDataAggregator):
+        # We do not have the individual maps to make movies from
+        make_movies = False
+        make_aggregate_plots(result)
+    else:
+        result = survis.analysis.CommonDataExtractor(result)
 
     sd_r_gas = result.sd_r[0, :]
     sd_r_star = result.sd_r[1, :]
@@ -168,30 +247,20 @@ def make_plots(result, make_movies=True, show_plots=False):
         Q_of_r_mov.save('Q_of_r_mov.mp4')
         sd_of_r_mov.save('sd_of_r_mov.mp4')
 
+        # Older pickles do not have the two fluid Q
+        if result.Q2_map is not None:
+            Q2_movie = make_movie_imshow(result.Q2_map, vmin=0, vmax=2)
+            Q2_movie.save('Q2_movie.mp4')
+
 
 if __name__ == "__main__":
     # Run in script mode
 
     import sys
-    import os
     import pickle
-    from multiprocessing import Pool
-    from functools import partial
-
-    # Physics Setup
-    bbox_x = [-30, 30]
-    bbox_y = bbox_x
-    res_elem = 0.5
-    res = survis.helper.get_res(res_elem, bbox_x, bbox_y)
-
-    # Computing Setup
-    n_cpus = os.cpu_count() if os.cpu_count() <= 8 else 8
 
-    n_snaps = get_snaps()
-    filenames = ["snapshot_{:03d}.hdf5".format(x) for x in range(n_snaps)]
-
-    if "--test" in sys.argv:
-        filenames = ['test_data.hdf5']
+    # The physics and computing setup is shared with survis.run
+    res, n_cpus, filenames = setup(sys.argv)
 
     if "--read" in sys.argv:
         print("Reading data")
@@ -200,20 +269,19 @@ if __name__ == "__main__":
 
     else:
         print("Beginning data analysis \n")
-
-        # We need more arguments than Pool.map allows
-        t = tqdm(total=int(n_snaps/n_cpus) + 1, desc="Data Processing")
-
-        def update():  # This is required because of pickling
-            t.update()
-
-        mapped_process = partial(processing_run,
-                                 res=res, bbox_x=bbox_x, bbox_y=bbox_y,
-                                 elem_size=res_elem,
-                                 callback=update)
-
-        with Pool(processes=n_cpus) as processing_pool:
-            result = processing_pool.map(mapped_process, filenames)
+        from tqdm import tqdm
+
+        pyramid_levels = get_pyramid_levels(sys.argv)
+        t = tqdm(total=len(filenames), desc="Data Processing")
+
+        if "--stream" in sys.argv:
+            result = aggregate(filenames, res, bbox_x, bbox_y, res_elem, n_cpus,
+                               callback=t.update)
+        else:
+            result = analyse(filenames, res, bbox_x, bbox_y, res_elem, n_cpus,
+                             callback=t.update,
+                             pyramid_levels=pyramid_levels)
+        t.close()
 
 
     if "--save" in sys.argv:
@@ -1,6 +1,19 @@
-import survis.preprocess as preprocess
-import survis.toomre as toomre
-import survis.helper as helper
-import survis.fiducial as fiducial
-import survis.profiles as profiles
-import survis.analysis as analysis
+""" The submodules are only imported when they are first used (e.g.
+    survis.profiles pulls in scipy), which keeps start up quick for
+    short runs and worker processes. """
+
+import importlib
+
+_submodules = ['pyramid', 'preprocess', 'toomre', 'helper', 'fiducial',
+               'profiles', 'analysis', 'run']
+
+
+def __getattr__(name):
+    if name in _submodules:
+        return importlib.import_module("survis." + name)
+
+    raise AttributeError("module 'survis' has no attribute '{}'".format(name))
+
+
+def __dir__():
+    return sorted(list(globals()) + _submodules)
@@ -3,7 +3,7 @@
 
 import numpy as np
 import survis
-from tqdm import tqdm
+from multiprocessing import shared_memory
 
 
 class CommonDataObject(object):
@@ -22,26 +22,47 @@ class CommonDataObject(object):
         self.sound_speed = survis.toomre.sound_speed_sne
         self.solar_radius = 8
         self.smoothing = 0.4
+        self.particle_bins = [0, 0.5, 3, 10, 100]
+
+        # Set to a number of levels N to keep a MapPyramid of the grids. Its
+        # finest level is then binned 2**(N - 1) times finer than res, and
+        # the maps are taken from level N - 1 (which is at res).
+        self.pyramid_levels = 0
 
         return
 
 
     def run_analysis(self):
+        refine = pyramid_refinement(self.pyramid_levels)
+
         data_grid = survis.preprocess.DataGridder(self.filename,
-                                                  self.res[0],
-                                                  self.res[1],
+                                                  self.res[0] * refine,
+                                                  self.res[1] * refine,
                                                   self.bbox_x[0],
                                                   self.bbox_x[1],
                                                   self.bbox_y[0],
-                                                  self.bbox_y[1])
+                                                  self.bbox_y[1],
+                                                  annulus_width=self.smoothing)
+
+        map_grid = data_grid
+
+        if self.pyramid_levels:
+            self.pyramid = data_grid.build_pyramid(self.pyramid_levels)
+            map_grid = self.pyramid.grid(self.pyramid_levels - 1,
+                                         annuli=data_grid.annuli)
 
-        self.Q_map = survis.helper.get_toomre_Q(data_grid,
+        self.Q_map = survis.helper.get_toomre_Q(map_grid,
                                                 self.sound_speed,
                                                 self.elem_size)
 
+        # Gas and stars each with their own Q, see toomre.Q_two_fluid
+        self.Q2_map = survis.helper.get_toomre_Q_two_fluid(map_grid,
+                                                           self.sound_speed,
+                                                           self.elem_size)
+
         # Normally the masses of each element are given, we must divide by size
         # as well as a conversion factor to give Msun / pc^2
-        self.sd_map = data_grid.gas_data['masses']/((1e6) * self.elem_size**2)
+        self.sd_map = map_grid.gas_data['masses']/((1e6) * self.elem_size**2)
 
 
         # Now the values at a given radius
@@ -59,31 +80,266 @@ class CommonDataObject(object):
                                                            self.smoothing,
                                                            self.bbox_x[1])
 
+        self.Q2_variation_with_r = survis.helper.toomre_Q_two_fluid_r(data_grid,
+                                                                      self.sound_speed,
+                                                                      self.bbox_x[1])
+
         self.sd_variation_with_r = survis.helper.sd_r(data_grid,
                                                       self.smoothing,
                                                       self.bbox_x[1])
 
-        self.n_part_r, self.bins = survis.helper.n_particles_bins(data_grid)
+        self.n_part_r, self.bins = survis.helper.n_particles_bins(data_grid,
+                                                                 self.particle_bins)
 
         self.vert_opt, self.vert_err = survis.profiles.vertical_profile(data_grid)
 
         return
 
 
+    def radii(self):
+        """ The radii of the profiles, as used by helper.toomre_Q_r and
+            helper.sd_r """
+        return np.arange(self.smoothing, self.bbox_x[1], self.smoothing)
+
+
+    def n_radii(self):
+        """ The number of radii in the profiles """
+        return len(self.radii())
+
+
+    def to_shared(self, shared, index):
+        """ Writes the results into row index of a SharedResults, so they
+            do not have to be pickled back to the parent process. """
+        shared.Q_map[index] = np.ma.filled(self.Q_map, 0.)
+        shared.Q_mask[index] = np.ma.getmaskarray(self.Q_map)
+        shared.Q2_map[index] = np.ma.filled(self.Q2_map, 0.)
+        shared.Q2_mask[index] = np.ma.getmaskarray(self.Q2_map)
+        shared.sd_map[index] = self.sd_map
+        shared.sd_r[index] = self.sd_r
+        shared.Q_r[index] = np.ma.filled(self.Q_r, np.nan)
+        shared.Q_variation_with_r[index] = filled(self.Q_variation_with_r)
+        shared.Q2_variation_with_r[index] = np.ma.filled(self.Q2_variation_with_r,
+                                                         np.nan)
+        shared.sd_variation_with_r[index] = self.sd_variation_with_r
+        shared.n_part_r[index] = self.n_part_r
+        shared.bins[index] = self.bins
+        shared.vert_opt[index] = self.vert_opt
+        shared.vert_err[index] = self.vert_err
+
+        if shared.pyramid_levels:
+            gas, star = self.pyramid.levels[0]
+            sums = {'gas': gas, 'star': star}
+            shared.pyramid_masses[index] = [self.pyramid.gas_mass,
+                                            self.pyramid.star_mass]
+
+            for name, keys in pyramid_sum_keys().items():
+                for key in keys:
+                    block = getattr(shared, "pyramid_{}_{}".format(name, key))
+                    block[index] = sums[name][key]
+
+        return
+
+
+    def from_shared(self, shared, index):
+        """ The reverse of to_shared, this copies the results out of row index
+            of a SharedResults so that it can be closed afterwards. """
+        self.Q_map = np.ma.array(shared.Q_map[index].copy(),
+                                 mask=shared.Q_mask[index].copy())
+        self.Q2_map = np.ma.array(shared.Q2_map[index].copy(),
+                                  mask=shared.Q2_mask[index].copy())
+        self.sd_map = shared.sd_map[index].copy()
+        self.sd_r = list(shared.sd_r[index])
+        self.Q_r = shared.Q_r[index]
+        self.Q_variation_with_r = list(np.ma.masked_invalid(
+            shared.Q_variation_with_r[index].copy()))
+        self.Q2_variation_with_r = np.ma.masked_invalid(
+            shared.Q2_variation_with_r[index].copy())
+        self.sd_variation_with_r = [list(x) for x in shared.sd_variation_with_r[index]]
+        self.n_part_r = shared.n_part_r[index].copy()
+        self.bins = shared.bins[index].copy()
+        self.vert_opt = shared.vert_opt[index]
+        self.vert_err = shared.vert_err[index]
+
+        if shared.pyramid_levels:
+            sums = {}
+
+            for name, keys in pyramid_sum_keys().items():
+                sums[name] = {}
+
+                for key in keys:
+                    block = getattr(shared, "pyramid_{}_{}".format(name, key))
+                    sums[name][key] = block[index].copy()
+
+            gas_mass, star_mass = shared.pyramid_masses[index]
+            self.pyramid = survis.pyramid.MapPyramid(sums['gas'], sums['star'],
+                                                     gas_mass, star_mass,
+                                                     self.bbox_x, self.bbox_y,
+                                                     self.pyramid_levels)
+
+        return
+
+
+class SharedResults(object):
+    """ Arrays in shared memory to hold the results of a CommonDataObject for
+        each of n_snaps snapshots, one row per snapshot.
+
+        The parent process creates this and passes descriptor() (which is
+        tiny) to the workers. They attach with SharedResults.attach, write
+        their row with CommonDataObject.to_shared and close(). The parent
+        then reads the rows back with CommonDataObject.from_shared and
+        finally calls unlink().
+
+        Use SharedResults.for_object to get the sizes right. """
+
+    def __init__(self, n_snaps, res, n_radii, n_part_bins, pyramid_levels=0,
+                 names=None):
+        """ res is the map resolution, n_radii the number of radii in the
+            profiles, n_part_bins the number of bins used by
+            helper.n_particles_bins and pyramid_levels the number of levels
+            of the MapPyramids (0 for none, see
+            CommonDataObject.pyramid_levels), of which the finest is kept.
+            If names (from descriptor) is given we attach to existing blocks
+            rather than creating them. """
+
+        self.n_snaps = n_snaps
+        self.res = res
+        self.n_radii = n_radii
+        self.n_part_bins = n_part_bins
+        self.pyramid_levels = pyramid_levels
+
+        self._blocks = {}
+
+        for key, (shape, dtype) in self.layout().items():
+            size = max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1)
+
+            if names is None:
+                block = shared_memory.SharedMemory(create=True, size=size)
+            else:
+                block = shared_memory.SharedMemory(name=names[key])
+
+            self._blocks[key] = block
+            setattr(self, key, np.ndarray(shape, dtype=dtype, buffer=block.buf))
+
+        return
+
+
+    @classmethod
+    def for_object(cls, n_snaps, cdo):
+        """ Makes the blocks for n_snaps results of CommonDataObjects set up
+            like cdo (which need not have been run). """
+        return cls(n_snaps, cdo.res, cdo.n_radii(), len(cdo.particle_bins) - 1,
+                   cdo.pyramid_levels)
+
+
+    def layout(self):
+        """ The shape and dtype of each of the result arrays """
+        n = self.n_snaps
+        rx, ry = self.res
+
+        layout = {'Q_map': ((n, rx, ry), np.float64),
+                'Q_mask': ((n, rx, ry), np.bool_),
+                'Q2_map': ((n, rx, ry), np.float64),
+                'Q2_mask': ((n, rx, ry), np.bool_),
+                'sd_map': ((n, rx, ry), np.float64),
+                'sd_r': ((n, 2), np.float64),
+                'Q_r': ((n,), np.float64),
+                'Q_variation_with_r': ((n, self.n_radii), np.float64),
+                'Q2_variation_with_r': ((n, self.n_radii), np.float64),
+                'sd_variation_with_r': ((n, self.n_radii, 2), np.float64),
+                'n_part_r': ((n, self.n_part_bins), np.int64),
+                'bins': ((n, self.n_part_bins + 1), np.float64),
+                'vert_opt': ((n,), np.float64),
+                'vert_err': ((n,), np.float64)}
+
+        if self.pyramid_levels:
+            # Only the finest level, the rest are rebuilt from it
+            refine = pyramid_refinement(self.pyramid_levels)
+            layout['pyramid_masses'] = ((n, 2), np.float64)
+
+            for name, keys in pyramid_sum_keys().items():
+                for key in keys:
+                    layout["pyramid_{}_{}".format(name, key)] = (
+                        (n, rx * refine, ry * refine), np.float64)
+
+        return layout
+
+
+    def descriptor(self):
+        """ Everything a worker needs to attach, small enough to pickle """
+        return {'n_snaps': self.n_snaps,
+                'res': self.res,
+                'n_radii': self.n_radii,
+                'n_part_bins': self.n_part_bins,
+                'pyramid_levels': self.pyramid_levels,
+                'names': {key: block.name for key, block in self._blocks.items()}}
+
+
+    @classmethod
+    def attach(cls, descriptor):
+        """ Attaches to the blocks created by another process """
+        return cls(**descriptor)
+
+
+    def close(self):
+        """ Detaches from the blocks (the arrays cannot be used after this) """
+        for key in self._blocks:
+            delattr(self, key)
+
+        for block in self._blocks.values():
+            block.close()
+
+        return
+
+
+    def unlink(self):
+        """ Closes and frees the blocks, should be called once by the parent """
+        blocks = list(self._blocks.values())
+        self.close()
+
+        for block in blocks:
+            block.unlink()
+
+        return
+
+
+def pyramid_refinement(pyramid_levels):
+    """ How many times finer than the maps the finest level of a MapPyramid
+        with pyramid_levels levels is (see CommonDataObject.pyramid_levels) """
+    return 2**max(pyramid_levels - 1, 0)
+
+
+def pyramid_sum_keys():
+    """ The sums kept in a MapPyramid for each particle type, as binned by
+        DataGridder (gas with densities, stars with dispersions) """
+    return {'gas': survis.preprocess.sum_keys(True),
+            'star': survis.preprocess.sum_keys(False, dispersion=True)}
+
+
+def filled(values):
+    """ The Q profiles are lists that can contain masked values (where
+        there are no particles), this turns them into an array with nan. """
+    return np.array([np.ma.filled(x, np.nan) for x in values], dtype=float)
+
+
 class CommonDataExtractor(object):
     """ This object is used to extract the data back to lists per snapshot.
         We begin with [CommonDataObject, CommonDataObject, ...] but really
         we want the actual data items [snap0, snap1, snap2] x N. This does
-        that. """
+        that.
+
+        Objects pickled before the two fluid Q was added have no Q2_map or
+        Q2_variation_with_r, if any are missing these are set to None. """
 
     def __init__(self, cdo_list):
         self.cdo_list = cdo_list
 
         self.Q_map = []
+        self.Q2_map = []
         self.sd_map = []
         self.sd_r = []
         self.Q_r = []
         self.Q_variation_with_r = []
+        self.Q2_variation_with_r = []
         self.sd_variation_with_r = []
         self.n_part_r = []
         self.bins = []
@@ -92,6 +348,10 @@ class CommonDataExtractor(object):
 
         self._reshape()
 
+        if any(x is None for x in self.Q2_map):
+            self.Q2_map = None
+            self.Q2_variation_with_r = None
+
         self.sd_r = self.clean(self.sd_r)
         self.Q_r = self.clean(self.Q_r)
         self.n_part_r = self.clean(self.n_part_r)
@@ -105,12 +365,16 @@ class CommonDataExtractor(object):
 
     
     def _reshape(self):
+        from tqdm import tqdm
+
         for item in tqdm(self.cdo_list, desc="Reshaping data"):
             self.Q_map.append(item.Q_map)
+            self.Q2_map.append(getattr(item, 'Q2_map', None))
             self.sd_map.append(item.sd_map)
             self.sd_r.append(item.sd_r)
             self.Q_r.append(item.Q_r)
             self.Q_variation_with_r.append(item.Q_variation_with_r)
+            self.Q2_variation_with_r.append(getattr(item, 'Q2_variation_with_r', None))
             self.sd_variation_with_r.append(item.sd_variation_with_r)
             self.n_part_r.append(item.n_part_r)
             self.bins.append(item.bins)
@@ -120,3 +384,131 @@ class CommonDataExtractor(object):
         return
 
 
+class RunningStatistics(object):
+    """ Keeps the mean and variance (using Welford's online algorithm) and
+        the minimum and maximum of a stream of equally shaped arrays, without
+        keeping the arrays. Masked and nan elements are skipped, so each
+        element has its own count. """
+
+    def __init__(self):
+        self.count = None
+
+        return
+
+
+    def add(self, values):
+        values = np.ma.masked_invalid(np.ma.asarray(values, dtype=float))
+        valid = ~np.ma.getmaskarray(values)
+        x = np.ma.filled(values, 0.)
+
+        if self.count is None:
+            self.count = np.zeros(x.shape)
+            self.running_mean = np.zeros(x.shape)
+            self.m2 = np.zeros(x.shape)
+            self.min = np.full(x.shape, np.inf)
+            self.max = np.full(x.shape, -np.inf)
+
+        self.count += valid
+        delta = x - self.running_mean
+        self.running_mean += valid * delta/np.maximum(self.count, 1)
+        self.m2 += valid * delta * (x - self.running_mean)
+
+        self.min = np.where(valid, np.minimum(self.min, x), self.min)
+        self.max = np.where(valid, np.maximum(self.max, x), self.max)
+
+        return
+
+
+    def _masked(self, values):
+        """ Masks out the elements that never had a valid value """
+        return np.ma.array(values, mask=(self.count == 0))
+
+
+    @property
+    def mean(self):
+        return self._masked(self.running_mean)
+
+
+    def variance(self, ddof=0):
+        """ Per-element variance, ddof=1 gives the sample variance """
+        n = self.count - ddof
+        return np.ma.array(self.m2/np.maximum(n, 1), mask=(n <= 0))
+
+
+    @property
+    def std(self):
+        return np.sqrt(self.variance())
+
+
+    @property
+    def minimum(self):
+        return self._masked(self.min)
+
+
+    @property
+    def maximum(self):
+        return self._masked(self.max)
+
+
+class CommonDataAggregator(object):
+    """ An alternative to CommonDataExtractor that takes the CommonDataObjects
+        one at a time, as they arrive from the workers, and does not keep them.
+
+        The per-snapshot values (Q_r, sd_r, n_part_r, bins, vert_opt and
+        vert_err) are kept in arrays in the same form as CommonDataExtractor
+        gives them. The maps and radial profiles are only kept as running
+        statistics over the snapshots (e.g. Q_map.mean, Q_map.variance(),
+        Q_map.minimum), so memory scales with the grid size rather than with
+        the number of snapshots times the grid size. """
+
+    def __init__(self, n_snaps):
+        self.n_snaps = n_snaps
+        self.n_added = 0
+
+        self.Q_map = RunningStatistics()
+        self.Q2_map = RunningStatistics()
+        self.sd_map = RunningStatistics()
+        self.Q_variation_with_r = RunningStatistics()
+        self.Q2_variation_with_r = RunningStatistics()
+        self.sd_variation_with_r = RunningStatistics()
+
+        self.Q_r = np.full(n_snaps, np.nan)
+        self.vert_opt = np.full(n_snaps, np.nan)
+        self.vert_err = np.full(n_snaps, np.nan)
+
+        # These are made when we know their shape
+        self.radii = None
+        self.sd_r = None
+        self.n_part_r = None
+        self.bins = None
+
+        return
+
+
+    def add(self, index, cdo):
+        """ Adds the CommonDataObject for snapshot number index. These may
+            be added in any order. """
+
+        if self.sd_r is None:
+            self.radii = cdo.radii()
+            self.sd_r = np.full((self.n_snaps, len(cdo.sd_r)), np.nan)
+            self.n_part_r = np.zeros((self.n_snaps, len(cdo.n_part_r)))
+            self.bins = np.zeros((self.n_snaps, len(cdo.bins)))
+
+        self.Q_map.add(cdo.Q_map)
+        self.Q2_map.add(cdo.Q2_map)
+        self.sd_map.add(cdo.sd_map)
+        self.Q_variation_with_r.add(filled(cdo.Q_variation_with_r))
+        self.Q2_variation_with_r.add(cdo.Q2_variation_with_r)
+        self.sd_variation_with_r.add(cdo.sd_variation_with_r)
+
+        self.Q_r[index] = np.ma.filled(cdo.Q_r, np.nan)
+        self.sd_r[index] = cdo.sd_r
+        self.n_part_r[index] = cdo.n_part_r
+        self.bins[index] = cdo.bins
+        self.vert_opt[index] = cdo.vert_opt
+        self.vert_err[index] = cdo.vert_err
+
+        self.n_added += 1
+
+        return
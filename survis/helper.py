@@ -41,6 +41,124 @@ def get_toomre_Q(DG, sound, res_elem):
     return np.ma.array(gas_q, mask=(gas_q == 0.))
 
 
+def get_toomre_Q_two_fluid(DG, sound, res_elem):
+    """ As get_toomre_Q, but the stars enter through their own Q (using the
+        radial velocity dispersion binned alongside the masses, see
+        DataGridder.bin_data) combined with the gas as in toomre.Q_two_fluid,
+        rather than as a fixed fraction of the gas surface density. """
+
+    area = res_elem**2
+    gas_sd = DG.gas_data['masses']/area
+    star_sd = DG.star_data['masses']/area
+
+    # Both components see the same rotation curve, use the stars where
+    # there is no gas
+    kappa = np.where(gas_sd > 0, DG.gas_data['velocities'],
+                     DG.star_data['velocities'])
+
+    q = toom.Q_two_fluid(sound, kappa, DG.gas_data['densities'], gas_sd,
+                         star_dispersion(DG), star_sd)
+
+    return np.ma.array(q, mask=np.logical_or(q == 0., np.isnan(q)))
+
+
+def star_dispersion(DG):
+    """ The stellar radial velocity dispersion in each cell of the grid.
+        A cell with a single star cannot give one, so it takes that of the
+        annulus its centre lies in (see DataGridder.annuli). If that cannot
+        give one either, or DG has no annuli, the dispersion is nan. """
+
+    dispersion = DG.star_data['dispersions'].copy()
+    counts = DG.star_data['counts']
+    unresolved = np.logical_and(counts > 0, counts < 2)
+
+    if not unresolved.any():
+        return dispersion
+
+    fallback = np.nan
+    annuli = getattr(DG, 'annuli', None)
+
+    if annuli is not None:
+        nx, ny = dispersion.shape
+        x = DG.bbox_x[0] + (np.arange(nx) + 0.5) * (DG.bbox_x[1] - DG.bbox_x[0])/nx
+        y = DG.bbox_y[0] + (np.arange(ny) + 0.5) * (DG.bbox_y[1] - DG.bbox_y[0])/ny
+
+        # Only the cells that need it, the annuli are evenly spaced
+        cell_x, cell_y = np.nonzero(unresolved)
+        r = np.sqrt(x[cell_x]**2 + y[cell_y]**2)
+        index = (r/annuli['edges'][1]).astype(int)
+
+        _, _, annulus_dispersion = annulus_means(annuli['star'])
+
+        inside = index < len(annulus_dispersion)
+        fallback = np.full(len(index), np.nan)
+        fallback[inside] = annulus_dispersion[index[inside]]
+
+    dispersion[unresolved] = fallback
+
+    return dispersion
+
+
+def annulus_means(sums):
+    """ Gives the particle counts, the mean of each of the other annular sums
+        (see DataGridder.bin_sums) and, if the radial velocities were kept,
+        the radial velocity dispersion (nan with fewer than 2 particles). """
+    counts = sums['counts']
+    n = np.maximum(counts, 1)
+    mean = {key: value/n for key, value in sums.items() if key != 'counts'}
+
+    dispersion = None
+
+    if 'v_r2' in sums:
+        dispersion = np.sqrt(np.maximum(mean['v_r2'] - np.square(mean['v_r']), 0))
+        dispersion[counts < 2] = np.nan
+
+    return counts, mean, dispersion
+
+
+def toomre_Q_two_fluid_r(DG, sound, max_radius):
+    """ The two fluid Q (see toomre.Q_two_fluid) at the same radii, and over
+        the same annuli (R - dR to R + dR), as toomre_Q_r with dR the
+        annulus width of DG. Like fiducial.toomre_Q_gas, kappa is sqrt(2)
+        times the mean speed over R.
+
+        Unlike toomre_Q_r this does not go back to the particles, it is made
+        from the annular sums kept by the DataGridder (see DataGridder.annuli). """
+
+    edges = DG.annuli['edges']
+    dR = edges[1]
+    radii = np.arange(dR, max_radius, dR)
+
+    if len(radii) == 0:
+        return np.ma.array(radii)
+
+    if len(radii) + 1 > len(edges) - 1:
+        raise ValueError("The annuli of DG only reach R = {}".format(edges[-1]))
+
+    def pairs(sums):
+        """ Bins k - 1 and k make up the annulus around radii[k - 1] """
+        return {key: value[:len(radii)] + value[1:len(radii) + 1]
+                for key, value in sums.items()}
+
+    gas_n, gas, _ = annulus_means(pairs(DG.annuli['gas']))
+    star_n, star, star_sigma = annulus_means(pairs(DG.annuli['star']))
+
+    # As fiducial.surface_density
+    area = 4 * np.pi * radii * dR
+    gas_sd = gas_n * DG.gas_mass/area
+    star_sd = star_n * DG.star_mass/area
+
+    speeds = np.where(gas_n > 0, gas['speeds'], star['speeds'])
+    kappa = np.sqrt(2) * speeds/radii
+
+    star_sigma[star_n == 0] = 0
+
+    q = toom.Q_two_fluid(sound, kappa, gas['densities'], gas_sd,
+                         star_sigma, star_sd)
+
+    return np.ma.array(q, mask=np.logical_or(q == 0., np.isnan(q)))
+
+
 def toomre_Q_r(DG, sound, res_elem, max_radius):
     """ Plots the toomre Q as a function of R using fiducial.toomre_Q_gas. """
     # Yes, this is very slow.
@@ -48,5 +48,42 @@ def vertical_profile(DG, bin_width=0.2, min=-10, max=10):
     return popt[1], np.sqrt(pcov[1,1])
 
 
+def vertical_profile_r(DG, r_edges, bin_width=0.2, min=-10, max=10,
+                       min_particles=10):
+    """ As vertical_profile, but fits the scale height separately in each
+        of the annuli given by r_edges using the (R, z) binning from
+        DG.bin_cylindrical. Annuli with fewer than min_particles particles,
+        or where the fit fails, are given nan. """
+    z_edges = np.arange(min, max, bin_width)
+
+    cube = DG.bin_cylindrical(DG.gas, 1., r_edges, 1, z_edges, hydro=False)
+    n_rz = cube['masses'][:, 0, :]
+    bincenters = bin_cent(z_edges)
+
+    def to_fit(z, norm, Z):
+        return norm*(1/(np.cosh(z/Z)**2))
+
+    heights = np.zeros(len(n_rz)) * np.nan
+    errors = np.zeros(len(n_rz)) * np.nan
+
+    for index, n in enumerate(n_rz):
+        if n.sum() < min_particles:
+            # Otherwise the starting guess comes back as a perfect fit
+            continue
+
+        try:
+            popt, pcov = curve_fit(to_fit, bincenters, n)
+        except RuntimeError:
+            continue
+
+        if not np.all(np.isfinite(pcov)):
+            continue
+
+        heights[index] = popt[1]
+        errors[index] = np.sqrt(pcov[1,1])
+
+    return heights, errors
+
+
 def local_jeans_length(DG):
     return 0
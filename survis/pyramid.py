@@ -0,0 +1,176 @@
+""" Contains MapPyramid, a stack of grids at successively halved resolution
+    built from the summed particle data of a DataGridder (see
+    DataGridder.build_pyramid).
+
+    Because the per-cell particle counts and sums of v/r and density are
+    kept rather than the means, any level (or any sub-window of a level)
+    can be turned back into surface density and Toomre Q maps without
+    going back to the particles. """
+
+import numpy as np
+
+
+class PyramidGrid(object):
+    """ One level (or a window of one) of a MapPyramid. This has gas_data and
+        star_data in the same format as a DataGridder so it can be handed to
+        e.g. helper.get_toomre_Q. The annuli of the DataGridder (see
+        DataGridder.annuli) can be passed on too, as they do not depend on
+        the resolution. """
+
+    def __init__(self, gas_data, star_data, bbox_x, bbox_y, elem_size,
+                 annuli=None):
+        self.gas_data = gas_data
+        self.star_data = star_data
+        self.annuli = annuli
+
+        self.bbox_x = bbox_x
+        self.bbox_y = bbox_y
+        self.elem_size = elem_size
+
+        return
+
+
+class MapPyramid(object):
+    def __init__(self, gas_sums, star_sums, gas_mass, star_mass, bbox_x, bbox_y,
+                 n_levels):
+        """ gas_sums and star_sums are the finest grids, as given by
+            DataGridder.bin_sums. Level 0 is that grid, and each of the
+            n_levels - 1 levels after it is 2x coarser. Grids with an odd
+            number of cells are padded with an empty row or column, so the
+            bbox of the coarser levels can grow by a cell on the max side. """
+
+        self.gas_mass = gas_mass
+        self.star_mass = star_mass
+        self.bbox_x = bbox_x
+        self.bbox_y = bbox_y
+
+        # Cell size of the finest level
+        shape = gas_sums['counts'].shape
+        self.dx = (bbox_x[1] - bbox_x[0])/shape[0]
+        self.dy = (bbox_y[1] - bbox_y[0])/shape[1]
+
+        self.levels = [(gas_sums, star_sums)]
+
+        for level in range(1, n_levels):
+            gas, star = self.levels[-1]
+            self.levels.append((downsample(gas), downsample(star)))
+
+        return
+
+
+    def __len__(self):
+        return len(self.levels)
+
+
+    def cell_size(self, level):
+        """ The (x, y) size of a cell at the given level in simulation units """
+        return self.dx * 2**level, self.dy * 2**level
+
+
+    def grid(self, level=0, window=None, annuli=None):
+        """ Gives a PyramidGrid for a level, optionally cut down to a window
+            [xmin, xmax, ymin, ymax] (simulation units). The window is
+            widened to the nearest whole cells. annuli is handed on to the
+            PyramidGrid. """
+
+        from survis.preprocess import finalise_sums
+
+        gas, star = self.levels[level]
+        dx, dy = self.cell_size(level)
+        shape = gas['counts'].shape
+
+        x_cells = slice(0, shape[0])
+        y_cells = slice(0, shape[1])
+
+        if window is not None:
+            x_cells = _window_slice(window[0], window[1], self.bbox_x[0], dx,
+                                    shape[0])
+            y_cells = _window_slice(window[2], window[3], self.bbox_y[0], dy,
+                                    shape[1])
+
+        gas = {key: value[x_cells, y_cells] for key, value in gas.items()}
+        star = {key: value[x_cells, y_cells] for key, value in star.items()}
+
+        bbox_x = [self.bbox_x[0] + x_cells.start * dx,
+                  self.bbox_x[0] + x_cells.stop * dx]
+        bbox_y = [self.bbox_y[0] + y_cells.start * dy,
+                  self.bbox_y[0] + y_cells.stop * dy]
+
+        return PyramidGrid(finalise_sums(gas, self.gas_mass),
+                           finalise_sums(star, self.star_mass),
+                           bbox_x, bbox_y, np.sqrt(dx * dy), annuli)
+
+
+    def surface_density(self, level=0, window=None):
+        """ Gas surface density map in Msun / pc^2, as in
+            analysis.CommonDataObject.sd_map. """
+        this_grid = self.grid(level, window)
+
+        return this_grid.gas_data['masses']/((1e6) * this_grid.elem_size**2)
+
+
+    def toomre_Q(self, sound_speed, level=0, window=None):
+        """ Toomre Q map (see helper.get_toomre_Q) at a level or window """
+        from survis.helper import get_toomre_Q
+
+        this_grid = self.grid(level, window)
+
+        return get_toomre_Q(this_grid, sound_speed, this_grid.elem_size)
+
+
+    def save(self, fname):
+        """ Writes the pyramid to an hdf5 file, see MapPyramid.load """
+        import h5py
+
+        with h5py.File(fname, 'w') as f:
+            f.attrs['gas_mass'] = self.gas_mass
+            f.attrs['star_mass'] = self.star_mass
+            f.attrs['bbox_x'] = self.bbox_x
+            f.attrs['bbox_y'] = self.bbox_y
+            f.attrs['n_levels'] = len(self)
+
+            gas, star = self.levels[0]
+
+            for name, sums in (('gas', gas), ('star', star)):
+                for key, value in sums.items():
+                    f.create_dataset("{}/{}".format(name, key), data=value)
+
+        return
+
+
+    @classmethod
+    def load(cls, fname):
+        """ Reads a pyramid written by MapPyramid.save. Only the finest level
+            is stored, the rest are rebuilt (this is cheap). """
+        import h5py
+
+        with h5py.File(fname, 'r') as f:
+            gas = {key: value[()] for key, value in f['gas'].items()}
+            star = {key: value[()] for key, value in f['star'].items()}
+
+            return cls(gas, star, f.attrs['gas_mass'], f.attrs['star_mass'],
+                       list(f.attrs['bbox_x']), list(f.attrs['bbox_y']),
+                       int(f.attrs['n_levels']))
+
+
+def downsample(sums):
+    """ Adds together 2x2 blocks of cells in each of the grids in sums """
+    ret = {}
+
+    for key, value in sums.items():
+        nx, ny = value.shape
+        padded = np.zeros((nx + nx % 2, ny + ny % 2))
+        padded[:nx, :ny] = value
+
+        ret[key] = padded.reshape(padded.shape[0]//2, 2,
+                                  padded.shape[1]//2, 2).sum(axis=(1, 3))
+
+    return ret
+
+
+def _window_slice(low, high, origin, size, n_cells):
+    """ The cells (clipped to the grid) covering [low, high) """
+    start = int(np.floor((low - origin)/size))
+    stop = int(np.ceil((high - origin)/size))
+
+    return slice(min(max(start, 0), n_cells), min(max(stop, 0), n_cells))
@@ -0,0 +1,270 @@
+""" The analysis-only entry point. This does the per-snapshot processing for
+    common.py without importing any of the plotting machinery (matplotlib,
+    tqdm), so it and each of its worker processes start up quickly.
+
+    Run it with python -m survis.run in a directory full of GADGET snapshot
+    files to write processed_variables.pkl, which can then be plotted
+    with common.py --read. Use --test to run on test_data.hdf5 instead, and
+    --stream to keep only the running statistics (see aggregate). With
+    --pyramid N each snapshot also keeps an N level map pyramid (see
+    survis.pyramid) of its grids. The finest level of that has cells of
+    res_elem / 2**(N - 1), so the inner disk can be looked at in more
+    detail without rerunning, while the maps stay at res_elem. """
+
+import os
+import pickle
+import queue
+from functools import partial
+from multiprocessing import Pool
+
+import survis
+
+# Physics Setup, shared with common.py
+bbox_x = [-30, 30]
+bbox_y = bbox_x
+res_elem = 0.5
+
+
+def new_object(filename, res, bbox_x, bbox_y, elem_size, pyramid_levels=0):
+    """ Sets up (but does not run) the CommonDataObject for a snapshot. This
+        is the one place the objects are configured, so the workers, the
+        parent and the shared memory layout all agree on it. """
+
+    this_data = survis.analysis.CommonDataObject(filename, res, bbox_x, bbox_y, elem_size)
+    this_data.pyramid_levels = pyramid_levels
+
+    return this_data
+
+
+def processing_run(filename, res, bbox_x, bbox_y, elem_size, callback=None,
+                   pyramid_levels=0):
+    """ Generates the processed data out of the snapshot. With pyramid_levels
+        the result also keeps a MapPyramid of its grids (see
+        CommonDataObject.pyramid_levels). """
+
+    this_data = new_object(filename, res, bbox_x, bbox_y, elem_size,
+                           pyramid_levels)
+    this_data.run_analysis()
+
+    if not (callback is None):
+        callback()
+
+    return this_data
+
+
+def shared_processing_run(index, filename, descriptor, res, bbox_x, bbox_y,
+                          elem_size, pyramid_levels=0):
+    """ As processing_run, but writes the result into row index of the
+        survis.analysis.SharedResults given by descriptor and only returns
+        the index, which is much cheaper to send back than the result. """
+
+    this_data = processing_run(filename, res, bbox_x, bbox_y, elem_size,
+                               pyramid_levels=pyramid_levels)
+
+    shared = survis.analysis.SharedResults.attach(descriptor)
+    this_data.to_shared(shared, index)
+    shared.close()
+
+    return index
+
+
+def collect_shared(shared, filenames, res, bbox_x, bbox_y, elem_size,
+                   pyramid_levels=0):
+    """ Reads the rows of shared back into CommonDataObjects, in the same
+        form as processing_run returns them. """
+    result = []
+
+    for index, filename in enumerate(filenames):
+        this_data = new_object(filename, res, bbox_x, bbox_y, elem_size,
+                               pyramid_levels)
+        this_data.from_shared(shared, index)
+        result.append(this_data)
+
+    return result
+
+
+def get_snaps(directory = "."):
+    n_snaps = 0
+
+    while "snapshot_{:03d}.hdf5".format(n_snaps) in os.listdir(directory):
+        n_snaps += 1
+        if n_snaps > 10000:
+            break
+
+    return n_snaps
+
+
+def setup(argv):
+    """ The setup shared by this and common.py. Gives the map resolution,
+        the number of cpus to use and the snapshot filenames (just
+        test_data.hdf5 with --test in argv). """
+
+    res = survis.helper.get_res(res_elem, bbox_x, bbox_y)
+
+    # Computing Setup
+    n_cpus = os.cpu_count() if os.cpu_count() <= 8 else 8
+
+    n_snaps = get_snaps()
+    filenames = ["snapshot_{:03d}.hdf5".format(x) for x in range(n_snaps)]
+
+    if "--test" in argv:
+        filenames = ['test_data.hdf5']
+
+    return res, n_cpus, filenames
+
+
+def get_pyramid_levels(argv):
+    """ The number of map pyramid levels given with --pyramid N, 0 if not.
+        The finest level is 2**(N - 1) times finer than res_elem. """
+    if "--pyramid" not in argv:
+        return 0
+
+    pyramid_levels = int(argv[argv.index("--pyramid") + 1])
+
+    if "--stream" in argv:
+        raise ValueError("--pyramid keeps a pyramid per snapshot, which "
+                         "--stream does not, use one or the other")
+
+    return pyramid_levels
+
+
+def analyse(filenames, res, bbox_x, bbox_y, elem_size, n_cpus=1,
+            callback=None, pyramid_levels=0):
+    """ Runs processing_run on each of the files and gives back the list of
+        CommonDataObjects. callback is called (in this process) each time a
+        snapshot finishes, e.g. to update a progress bar. If pyramid_levels
+        is given each result also keeps a MapPyramid of its grids.
+
+        With more than one cpu the workers write their results straight into
+        shared memory (see survis.analysis.SharedResults) rather than
+        pickling them back through the pool. With one cpu, or one file,
+        no pool is started at all. """
+
+    n_cpus = min(n_cpus, len(filenames))
+
+    if n_cpus <= 1:
+        return [processing_run(filename, res, bbox_x, bbox_y, elem_size,
+                               callback=callback,
+                               pyramid_levels=pyramid_levels)
+                for filename in filenames]
+
+    template = new_object(filenames[0], res, bbox_x, bbox_y, elem_size,
+                          pyramid_levels)
+    shared = survis.analysis.SharedResults.for_object(len(filenames), template)
+
+    mapped_process = partial(_shared_job, descriptor=shared.descriptor(),
+                             res=res, bbox_x=bbox_x, bbox_y=bbox_y,
+                             elem_size=elem_size,
+                             pyramid_levels=pyramid_levels)
+
+    try:
+        with Pool(processes=n_cpus) as processing_pool:
+            for index in processing_pool.imap_unordered(mapped_process,
+                                                        enumerate(filenames)):
+                if not (callback is None):
+                    callback()
+
+        result = collect_shared(shared, filenames, res, bbox_x, bbox_y,
+                                elem_size, pyramid_levels)
+    finally:
+        shared.unlink()
+
+    return result
+
+
+def aggregate(filenames, res, bbox_x, bbox_y, elem_size, n_cpus=1,
+              callback=None):
+    """ As analyse, but each result is fed into a
+        survis.analysis.CommonDataAggregator as soon as it arrives and then
+        dropped, so memory does not grow with the number of snapshots.
+
+        The workers write into a small pool of 2 * n_cpus shared memory
+        slots; a slot is only handed out again once its contents have been
+        added to the aggregator. Map pyramids are per snapshot, so they are
+        not kept here; use analyse for those. """
+
+    aggregator = survis.analysis.CommonDataAggregator(len(filenames))
+    n_cpus = min(n_cpus, len(filenames))
+
+    if n_cpus <= 1:
+        for index, filename in enumerate(filenames):
+            aggregator.add(index, processing_run(filename, res, bbox_x, bbox_y,
+                                                 elem_size, callback=callback))
+
+        return aggregator
+
+    n_slots = 2 * n_cpus
+    template = new_object(filenames[0], res, bbox_x, bbox_y, elem_size)
+    shared = survis.analysis.SharedResults.for_object(n_slots, template)
+    descriptor = shared.descriptor()
+
+    jobs = enumerate(filenames)
+    finished = queue.Queue()
+
+    try:
+        with Pool(processes=n_cpus) as processing_pool:
+
+            def submit(slot):
+                """ Starts the next snapshot in slot, if there are any left """
+                job = next(jobs, None)
+
+                if job is None:
+                    return 0
+
+                index, filename = job
+                processing_pool.apply_async(
+                    shared_processing_run,
+                    (slot, filename, descriptor, res, bbox_x, bbox_y, elem_size),
+                    callback=lambda slot: finished.put((index, slot, None)),
+                    error_callback=lambda error: finished.put((index, None, error)))
+
+                return 1
+
+            running = sum(submit(slot) for slot in range(n_slots))
+
+            while running:
+                index, slot, error = finished.get()
+
+                if error is not None:
+                    raise error
+
+                this_data = new_object(filenames[index], res, bbox_x, bbox_y,
+                                       elem_size)
+                this_data.from_shared(shared, slot)
+                aggregator.add(index, this_data)
+
+                if not (callback is None):
+                    callback()
+
+                running += submit(slot) - 1
+    finally:
+        shared.unlink()
+
+    return aggregator
+
+
+def _shared_job(job, **kwargs):
+    """ imap only passes one argument, this unpacks (index, filename) """
+    return shared_processing_run(job[0], job[1], **kwargs)
+
+
+if __name__ == "__main__":
+    # Run in script mode
+
+    import sys
+
+    res, n_cpus, filenames = setup(sys.argv)
+    pyramid_levels = get_pyramid_levels(sys.argv)
+
+    print("Beginning data analysis of {} snapshots".format(len(filenames)))
+
+    # --stream keeps only running statistics, see aggregate
+    if "--stream" in sys.argv:
+        result = aggregate(filenames, res, bbox_x, bbox_y, res_elem, n_cpus)
+    else:
+        result = analyse(filenames, res, bbox_x, bbox_y, res_elem, n_cpus,
+                         pyramid_levels=pyramid_levels)
+
+    print("Saving data to processed_variables.pkl")
+    with open('processed_variables.pkl', 'wb') as pck:
+        pickle.dump(result, pck)
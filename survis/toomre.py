@@ -30,5 +30,53 @@ def Q_gas(sound_speed, kappa, density, surface_density, G=4.302e-6):
     return ((c_s * kappa)/(np.pi * G * sd_masked))
 
 
-def Q_star():
-    return
+def Q_star(kappa, dispersion, surface_density, G=4.302e-6):
+    # Uses pi rather than 3.36 so that it can be combined with Q_gas as in
+    # Romeo & Wiegert 2011 (1101.4519)
+    sd_masked = surface_density + (surface_density == 0)
+    q = (dispersion * kappa)/(np.pi * G * sd_masked)
+    q[surface_density == 0] = 0
+
+    return q
+
+
+def Q_two_fluid(sound_speed, kappa, density, gas_surface_density, dispersion,
+                star_surface_density, G=4.302e-6):
+    """ The effective Q of gas and stars together, using the approximation
+        of Romeo & Wiegert 2011 (1101.4519):
+
+            1/Q = W/Q_star + 1/Q_gas    if Q_star >= Q_gas
+            1/Q = 1/Q_star + W/Q_gas    otherwise
+
+        with W = 2 sigma c_s / (sigma^2 + c_s^2). This works on whole arrays,
+        so on maps or radial profiles alike.
+
+        A component with no surface density does not contribute. As with
+        Q_gas, cells with neither component are given 0. Where there are
+        stars but their dispersion is unknown (nan) so is Q. """
+
+    # The sound speed is needed twice, but only worked out once
+    c_s = sound_speed(density)
+
+    # Without stars their dispersion (which may be nan) does not matter
+    dispersion = np.where(star_surface_density > 0, dispersion, 0)
+
+    # Work with 1/Q so that missing components (Q of 0) are just 0
+    inv_gas = _inverse(Q_gas(lambda density: c_s.copy(), kappa, density,
+                             gas_surface_density, G))
+    inv_star = _inverse(Q_star(kappa, dispersion, star_surface_density, G))
+
+    c_s[gas_surface_density == 0] = 0
+
+    width = np.square(dispersion) + np.square(c_s)
+    W = 2 * dispersion * c_s/np.where(width > 0, width, 1)
+
+    inv_q = np.where(inv_star <= inv_gas, W * inv_star + inv_gas,
+                     inv_star + W * inv_gas)
+
+    return _inverse(inv_q)
+
+
+def _inverse(x):
+    """ 1/x, but with 0 (no particles, see Q_gas) staying 0 """
+    return np.where(x == 0, 0, 1/np.where(x == 0, 1, x))
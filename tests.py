@@ -2,8 +2,12 @@ import survis.preprocess as pre
 import survis.toomre as toom
 import survis.helper as hp
 import survis.fiducial as fid
+import survis.profiles as prof
+import survis.analysis as an
+import matplotlib
 import matplotlib.pyplot as plt
 import numpy as np
+import warnings
 
 print("Running preprocess.py tests")
 # Plots a few things with the example data
@@ -45,6 +49,142 @@ plt.imshow(gas_d)
 plt.title('Gas density')
 h.show()
 
+# Edge-on (seen along the simulation x axis) and inclined projections
+edge_on = pre.rotation_matrix(pre.inclined_los(90))
+inclined = pre.rotation_matrix(pre.inclined_los(60))
+DG_edge = pre.DataGridder(fname, res[0], res[1], -100, 100, -100, 100,
+                          rotation=edge_on)
+
+e = plt.figure(6)
+plt.imshow(DG_edge.gas_data['masses'])
+plt.title('Gas mass (edge-on)')
+e.show()
+
+# The binning should agree with a histogram of the rotated coordinates
+coords = DG.gas['Coordinates'][()]
+
+for rotation, grid in zip([edge_on, inclined],
+                          DG.bin_projections(DG.gas, DG.gas_mass,
+                                             [edge_on, inclined])):
+    rotated = np.dot(coords, rotation.T)
+    n_hist, _, _ = np.histogram2d(rotated[:, 0], rotated[:, 1], bins=res,
+                                  range=[[-100, 100], [-100, 100]])
+    np.testing.assert_allclose(grid['masses'], n_hist * DG.gas_mass)
+
+np.testing.assert_allclose(DG_edge.gas_data['masses'],
+                           DG.bin_projections(DG.gas, DG.gas_mass,
+                                              [edge_on])[0]['masses'])
+print("Rotated projections match np.histogram2d")
+
+print("Running profiles.py tests")
+
+heights, height_errors = prof.vertical_profile_r(DG, np.arange(0, 30, 5))
+print("Scale height in 5 kpc annuli: {} +/- {}".format(heights, height_errors))
+
+# There are no particles this far out, so there is nothing to fit
+heights, height_errors = prof.vertical_profile_r(DG, [0, 5, 200, 300, 400])
+assert np.all(np.isfinite(heights[:2])) and np.all(np.isnan(heights[2:]))
+assert np.all(np.isnan(height_errors[2:]))
+
+print("Running pyramid.py tests")
+
+pyramid = DG.build_pyramid(4)
+
+# Each level is made by adding up cells, so the totals must not change
+for level in range(len(pyramid)):
+    gas, star = pyramid.levels[level]
+    for key, value in DG.gas_sums.items():
+        np.testing.assert_allclose(gas[key].sum(), value.sum())
+    for key, value in DG.star_sums.items():
+        np.testing.assert_allclose(star[key].sum(), value.sum())
+
+# A window is widened to whole cells of its level (10 units at level 1)
+window = pyramid.grid(1, [-25, 25, -25, 25])
+print("Level 1 window bbox: {}, {}".format(window.bbox_x, window.bbox_y))
+assert window.bbox_x == [-30, 30] and window.bbox_y == [-30, 30]
+assert window.gas_data['masses'].shape == (6, 6)
+
+# A pyramid binned 2x finer gives back the original maps at level 1, which
+# is how CommonDataObject keeps a finer pyramid without changing its maps
+DG_fine = pre.DataGridder(fname, 2 * res[0], 2 * res[1], -100, 100, -100, 100)
+level_1 = DG_fine.build_pyramid(2).grid(1, annuli=DG.annuli)
+np.testing.assert_allclose(level_1.gas_data['masses'], DG.gas_data['masses'])
+np.testing.assert_allclose(hp.get_toomre_Q(level_1, toom.sound_speed, res_elem),
+                           hp.get_toomre_Q(DG, toom.sound_speed, res_elem))
+
+k = plt.figure(7)
+plt.imshow(pyramid.surface_density(2))
+plt.title('Gas surface density (pyramid level 2)')
+k.show()
+
+print("Running analysis.py tests")
+
+# The running statistics should agree with doing it all at once
+rng = np.random.default_rng(42)
+stack = rng.normal(1., 0.5, (20, 8, 8))
+stack[rng.random(stack.shape) < 0.1] = np.nan
+masks = rng.random(stack.shape) < 0.1
+masks[:, 0, 0] = True  # one element with no valid values at all
+
+stats = an.RunningStatistics()
+for values, mask in zip(stack, masks):
+    stats.add(np.ma.array(values, mask=mask))
+
+# A snapshot with nothing valid changes nothing
+stats.add(np.full((8, 8), np.nan))
+stack = np.where(masks, np.nan, stack)
+
+with warnings.catch_warnings():
+    warnings.simplefilter("ignore", RuntimeWarning)  # the all-nan element
+    expected = [(stats.mean, np.nanmean(stack, 0)),
+                (stats.variance(), np.nanvar(stack, 0)),
+                (stats.variance(ddof=1), np.nanvar(stack, 0, ddof=1)),
+                (stats.minimum, np.nanmin(stack, 0)),
+                (stats.maximum, np.nanmax(stack, 0))]
+
+for running, direct in expected:
+    assert running.mask[0, 0]
+    np.testing.assert_allclose(np.ma.filled(running, np.nan), direct)
+print("RunningStatistics matches np.nanmean, np.nanvar, np.nanmin, np.nanmax")
+
+# Results must come back out of shared memory as they went in
+cdo = an.CommonDataObject(fname, hp.get_res(1, [-30, 30], [-30, 30]),
+                          [-30, 30], [-30, 30], 1)
+cdo.pyramid_levels = 2
+cdo.run_analysis()
+
+shared = an.SharedResults.for_object(1, cdo)
+try:
+    cdo.to_shared(shared, 0)
+    copy = an.CommonDataObject(fname, cdo.res, cdo.bbox_x, cdo.bbox_y,
+                               cdo.elem_size)
+    copy.pyramid_levels = cdo.pyramid_levels
+    copy.from_shared(shared, 0)
+finally:
+    shared.unlink()
+
+for key in ['Q_map', 'Q2_map', 'Q2_variation_with_r']:
+    original, restored = getattr(cdo, key), getattr(copy, key)
+    np.testing.assert_array_equal(np.ma.getmaskarray(original),
+                                  np.ma.getmaskarray(restored))
+    np.testing.assert_allclose(np.ma.filled(original, np.nan),
+                               np.ma.filled(restored, np.nan))
+
+for key in ['sd_map', 'sd_r', 'Q_r', 'sd_variation_with_r', 'n_part_r', 'bins',
+            'vert_opt', 'vert_err']:
+    np.testing.assert_allclose(np.ma.filled(getattr(copy, key), np.nan),
+                               np.ma.filled(getattr(cdo, key), np.nan))
+
+np.testing.assert_allclose(an.filled(copy.Q_variation_with_r),
+                           an.filled(cdo.Q_variation_with_r))
+
+for level in range(len(cdo.pyramid)):
+    for original, restored in zip(cdo.pyramid.levels[level],
+                                  copy.pyramid.levels[level]):
+        for key, value in original.items():
+            np.testing.assert_allclose(restored[key], value)
+print("CommonDataObject survives a round trip through SharedResults")
+
 print("Running fiducial.py tests")
 
 sgas, sstar = fid.surface_density(DG, 15, 2)
@@ -53,16 +193,69 @@ print("Gas Toomre Q: {}".format(fid.toomre_Q_gas(DG, 15, 2)))
 
 print("Running toomre.py tests")
 
-import matplotlib.cm as cm
 i = plt.figure(4)
 
 toomQ = hp.get_toomre_Q(DG, toom.sound_speed, res_elem)
-cmap = cm.viridis
-cmap.set_bad('white', -1.)
+cmap = matplotlib.colormaps['viridis'].copy()
+cmap.set_bad('white', 1.)
 
 plt.imshow(toomQ, cmap)
 plt.title('Gas Q')
 plt.colorbar()
 i.show()
 
+j = plt.figure(5)
+
+toomQ2 = hp.get_toomre_Q_two_fluid(DG, toom.sound_speed, res_elem)
+
+plt.imshow(toomQ2, cmap)
+plt.title('Two fluid (gas + star) Q')
+plt.colorbar()
+j.show()
+
+# With only one component the two fluid Q is just the Q of that component
+kappa = DG.gas_data['velocities']
+density = DG.gas_data['densities']
+gas_sd = DG.gas_data['masses']/res_elem**2
+star_sd = DG.star_data['masses']/res_elem**2
+sigma = hp.star_dispersion(DG)
+no_stars = np.zeros_like(star_sd)
+
+np.testing.assert_allclose(toom.Q_two_fluid(toom.sound_speed, kappa, density,
+                                            gas_sd, sigma, no_stars),
+                           toom.Q_gas(toom.sound_speed, kappa, density, gas_sd))
+
+resolved = ~np.isnan(sigma)
+np.testing.assert_allclose(toom.Q_two_fluid(toom.sound_speed, kappa, density,
+                                            np.zeros_like(gas_sd), sigma,
+                                            star_sd)[resolved],
+                           toom.Q_star(kappa, sigma, star_sd)[resolved])
+
+# Cells with one star take the dispersion of their annulus (see
+# DataGridder.annuli), worked out here straight from the particles
+star_coords = DG.star['Coordinates'][()]
+ring = (fid.rss(star_coords)/DG.annulus_edges[1]).astype(int)
+v_r = pre.radial_velocity(star_coords, DG.star['Velocities'][()])
+
+single = DG.star_data['counts'] == 1
+centres = -100 + (np.arange(res[0]) + 0.5) * res_elem
+cell_ring = (np.hypot(centres[:, None], centres[None, :])/res_elem).astype(int)
+
+for cell_x, cell_y in zip(*np.nonzero(single)):
+    in_ring = v_r[ring == cell_ring[cell_x, cell_y]]
+
+    if len(in_ring) < 2:
+        assert toomQ2.mask[cell_x, cell_y]
+    else:
+        # The sums lose a little precision against np.std
+        np.testing.assert_allclose(sigma[cell_x, cell_y], np.std(in_ring),
+                                   rtol=1e-4)
+
+# and so are not dropped: where there is gas as well, the stars lower Q
+with_gas = single & resolved & (gas_sd > 0)
+gas_only = toom.Q_two_fluid(toom.sound_speed, kappa, density, gas_sd, sigma,
+                            no_stars)
+assert with_gas.any() and np.all(toomQ2[with_gas] < gas_only[with_gas])
+print("Two fluid Q checked in {} single star cells".format(single.sum()))
+
 input()  # keep figures alive